@@ -9,9 +9,26 @@
 # QC Implementation:
 #   - Investment universe consist of stocks with earnings data available.
 
-from pandas.tseries.offsets import BDay
 from AlgorithmImports import *
 import data_tools
+import heapq
+import itertools
+from numba import njit
+import orjson
+
+
+@njit(cache=True)
+def compute_momentum(price_matrix, heads, counts, rows):
+    # momentum of each given row as latest / oldest price - 1, NaN for rows without a full period of prices
+    period: int = price_matrix.shape[1]
+    momentum = np.full(len(rows), np.nan)
+    for i in range(len(rows)):
+        row = rows[i]
+        if counts[row] == period:
+            # once a row is full, its head points at the oldest price
+            head = heads[row]
+            momentum[i] = price_matrix[row, (head - 1) % period] / price_matrix[row, head] - 1.0
+    return momentum
 
 
 class PostEarningsAnnouncement(QCAlgorithm):
@@ -26,38 +43,62 @@ class PostEarningsAnnouncement(QCAlgorithm):
         self.rebalance_period: int = 3  # referes to months, which has to pass, before next portfolio rebalance
 
         self.leverage: int = 1
+        self.fee_model: data_tools.CustomFeeModel = data_tools.CustomFeeModel()  # stateless, shared by all securities
 
-        self.data: dict[Symbol, data_tools.SymbolData] = {}
         self.selected_symbols: list[Symbol] = []
+        self.symbol_tickers: dict[Symbol, str] = {}  # cached Symbol.Value lookups
 
         # 50 equally weighted brackets for traded symbols
         self.managed_symbols_size: int = 7
-        self.managed_symbols: list[data_tools.ManagedSymbol] = []
+        self.managed_symbols: dict[Symbol, data_tools.ManagedSymbol] = {}
+        # min-heap of (date_to_liquidate, sequence, symbol), so OnData only touches due symbols
+        self.liquidation_queue: list[tuple[datetime.date, int, Symbol]] = []
+        self.liquidation_sequence = itertools.count()
 
         # earning data parsing
-        self.earnings: dict[datetime.date, list[str]] = {}
-        days_before_earnings: list[datetime.date] = []
+        self.bday_cache: dict[tuple[datetime.date, int], datetime.date] = {}
 
         # Empty dictionary for option contracts
         self.option_contracts: dict[Symbol, Option] = {}
 
-        earnings_set: Set(str) = set()
+        # flat earnings rows, one (date, ticker) pair per announcement in earnings data order, repeats listed once
+        earnings_rows: dict[tuple[datetime.date, str], None] = {}
         earnings_data: str = self.Download('data.quantpedia.com/backtesting_data/economic/earnings_dates_eps.json')
-        earnings_data_json: list[dict] = json.loads(earnings_data)
+        earnings_data_json: list[dict] = orjson.loads(earnings_data)
 
         for obj in earnings_data_json:
-            date: datetime.date = datetime.strptime(obj['date'], "%Y-%m-%d").date()
-
-            self.earnings[date] = []
-            days_before_earnings.append(date - BDay(5))
+            earnings_date: datetime.date = date.fromisoformat(obj['date'])
 
             for stock_data in obj['stocks']:
                 ticker: str = stock_data['ticker']
 
-                self.earnings[date].append(ticker)
-                earnings_set.add(ticker)
+                earnings_rows[earnings_date, ticker] = None
+
+        dates, tickers = zip(*earnings_rows) if earnings_rows else ((), ())
+
+        # earnings rows sorted by date, unique tickers of the i-th unique date are
+        # earnings_tickers[earnings_start_idx[i]:earnings_start_idx[i + 1]]
+        earnings_dates_arr: np.ndarray = np.array(dates, dtype='datetime64[D]')
+        order: np.ndarray = np.argsort(earnings_dates_arr, kind='stable')
+        self.earnings_tickers: np.ndarray = np.array(tickers, dtype=str)[order]
+        self.earnings_days, earnings_start_idx = np.unique(earnings_dates_arr[order], return_index=True)
+        self.earnings_start_idx: np.ndarray = np.append(earnings_start_idx, len(order))
 
-        self.earnings_universe: list[str] = list(earnings_set)
+        self.earnings_universe: frozenset[str] = frozenset(tickers)
+
+        # unique, sorted days 5 business days before each earnings date
+        days_before_earnings: list[datetime.date] = np.unique(
+            np.busday_offset(self.earnings_days, -5, roll='forward')).tolist()
+
+        # daily prices of all tracked symbols, one ring buffer row per symbol
+        max_symbols: int = max(len(self.earnings_universe), 1)
+        self.price_matrix: np.ndarray = np.full((max_symbols, self.period), np.nan, dtype=np.float32)
+        self.heads: np.ndarray = np.zeros(max_symbols, dtype=np.int64)  # column of the next price write
+        self.counts: np.ndarray = np.zeros(max_symbols, dtype=np.int64)  # number of stored prices
+        self.symbol_rows: dict[Symbol, int] = {}
+        self.row_symbols: list[Symbol] = []
+        self.ticker_rows: dict[str, int] = {}
+        self.selected_mask: np.ndarray = np.zeros(max_symbols, dtype=np.bool_)  # rows of the selected symbols
 
         self.symbol: Symbol = self.AddEquity('SPY', Resolution.Daily).Symbol
 
@@ -68,6 +109,7 @@ class PostEarningsAnnouncement(QCAlgorithm):
 
         self.months_counter: int = 0
         self.selection_flag: bool = False
+        self.last_selection_date: datetime.date = None
         self.UniverseSettings.Resolution = Resolution.Daily
         self.AddUniverse(self.CoarseSelectionFunction)
 
@@ -80,55 +122,106 @@ class PostEarningsAnnouncement(QCAlgorithm):
     def OnSecuritiesChanged(self, changes):
         for security in changes.AddedSecurities:
             security.SetDataNormalizationMode(DataNormalizationMode.Raw)
-            security.SetFeeModel(data_tools.CustomFeeModel())
+            security.SetFeeModel(self.fee_model)
             security.SetLeverage(self.leverage)
 
     def CoarseSelectionFunction(self, coarse):
-        # daily update of prices
-        for stock in coarse:
-            symbol: Symbol = stock.Symbol
-            if symbol is not None and symbol in self.data:
-                self.data[symbol].update(stock.AdjustedPrice)
-
-        if not self.selection_flag:
+        # daily update of prices, only for the tracked symbols present in today's coarse data
+        prices: dict[Symbol, float] = {stock.Symbol: stock.AdjustedPrice for stock in coarse}
+        tracked: list[Symbol] = list(self.symbol_rows.keys() & prices.keys())
+
+        if tracked:
+            self.UpdatePrices(np.fromiter((self.symbol_rows[symbol] for symbol in tracked), dtype=np.int64,
+                                          count=len(tracked)),
+                              np.fromiter((prices[symbol] for symbol in tracked), dtype=np.float32,
+                                          count=len(tracked)))
+
+        # at most one selection attempt per day
+        if not self.selection_flag or self.last_selection_date == self.Time.date():
             return Universe.Unchanged
         self.selection_flag = False
+        self.last_selection_date = self.Time.date()
 
-        selected: list[Symbol] = [x.Symbol for x in coarse if x.HasFundamentalData
-                                  and x.Market == 'usa' and x.Price > 5
-                                  and x.Symbol.Value in self.earnings_universe]
-
-        # warm up prices
-        for symbol in selected:
-            if symbol in self.data:
+        selected: list[Symbol] = []
+        earnings_universe: frozenset[str] = self.earnings_universe
+        for x in coarse:
+            if not (x.HasFundamentalData and x.Market == 'usa' and x.Price > 5):
                 continue
 
-            self.data[symbol] = data_tools.SymbolData(self.period)
-            history = self.History(symbol, self.period, Resolution.Daily)
+            symbol: Symbol = x.Symbol
+            ticker: str = symbol.Value
+            if ticker in earnings_universe:
+                self.symbol_tickers[symbol] = ticker
+                selected.append(symbol)
+
+        # warm up prices of newly selected symbols with a single history request
+        new_symbols: list[Symbol] = [symbol for symbol in selected if symbol not in self.symbol_rows]
+        for symbol in new_symbols:
+            self.AddSymbolRow(symbol)
+
+        if new_symbols:
+            history = self.History(new_symbols, self.period, Resolution.Daily)
 
             if history.empty:
-                self.Log(f"Not enough data for {symbol} yet")
-                continue
+                self.Log(f"Not enough data for {len(new_symbols)} new symbols yet")
+            else:
+                for symbol, closes in history.groupby(level=0)['close']:
+                    self.LoadPrices(self.symbol_rows[symbol], closes.to_numpy(dtype=np.float32))
 
-            closes = history.loc[symbol].close
-            for _, close in closes.iteritems():
-                self.data[symbol].update(close)
+        # map today's tickers to rows, so renamed or reused tickers point at their current symbol
+        self.ticker_rows = {self.symbol_tickers[symbol]: self.symbol_rows[symbol] for symbol in selected}
 
         # calculate momentum for each stock in self.earnings_universe
-        momentum: dict[Symbol, float] = {symbol: self.data[symbol].performance() for symbol in selected if
-                                         self.data[symbol].is_ready()}
+        rows: np.ndarray = np.fromiter((self.symbol_rows[symbol] for symbol in selected), dtype=np.int64,
+                                       count=len(selected))
+        momentum: np.ndarray = compute_momentum(self.price_matrix, self.heads, self.counts, rows)
+        valid: np.ndarray = np.isfinite(momentum)
+        momentum, candidates = momentum[valid], np.asarray(selected, dtype=object)[valid]
 
         if len(momentum) < self.quantile:
             self.selected_symbols = []
+            self.selected_mask[:] = False
+            # not enough data, retry the selection on the next day instead of waiting for the next rebalance
+            self.selection_flag = True
             return Universe.Unchanged
 
         quantile: int = int(len(momentum) / self.quantile)
-        sorted_by_mom: list[Symbol] = [x[0] for x in sorted(momentum.items(), key=lambda item: item[1])]
-        # the investor uses only stocks from the top momentum quantile
-        self.selected_symbols = [symbol for symbol in sorted_by_mom[-quantile:] if symbol is not None]
+        # the investor uses only stocks from the top momentum quantile, their order does not matter
+        k: int = len(momentum) - quantile
+        top_idx: np.ndarray = np.argpartition(momentum, k)[k:]
+        self.selected_symbols = [symbol for symbol in candidates[top_idx] if symbol is not None]
+        self.selected_mask[:] = False
+        self.selected_mask[rows[valid][top_idx]] = True
 
         return self.selected_symbols
 
+    def AddSymbolRow(self, symbol):
+        # assign the symbol a price matrix row, doubling the matrix when it is full
+        row: int = len(self.symbol_rows)
+        if row == len(self.price_matrix):
+            self.price_matrix = np.vstack([self.price_matrix, np.full_like(self.price_matrix, np.nan)])
+            self.heads = np.concatenate([self.heads, np.zeros_like(self.heads)])
+            self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+            self.selected_mask = np.concatenate([self.selected_mask, np.zeros_like(self.selected_mask)])
+
+        self.symbol_rows[symbol] = row
+        self.row_symbols.append(symbol)
+        return row
+
+    def LoadPrices(self, row, closes):
+        # fill an empty row's ring buffer with the most recent prices in one slice assignment
+        closes = closes[-self.period:]
+        self.price_matrix[row, :len(closes)] = closes
+        self.heads[row] = len(closes) % self.period
+        self.counts[row] = len(closes)
+
+    def UpdatePrices(self, rows, prices):
+        # push one new price into each row's ring buffer
+        heads = self.heads[rows]
+        self.price_matrix[rows, heads] = prices
+        self.heads[rows] = (heads + 1) % self.period
+        self.counts[rows] = np.minimum(self.counts[rows] + 1, self.period)
+
     def SelectOptionContract(self, underlying_symbol, expiry_date):
         if underlying_symbol not in self.option_contracts:
             # Add option for the underlying symbol
@@ -150,32 +243,44 @@ class PostEarningsAnnouncement(QCAlgorithm):
         contracts = sorted(contracts, key=lambda x: x.ID.Date.date())
         return contracts[0]
 
+    def AddBusinessDays(self, date, n):
+        # every (date, offset) pair is computed once, weekend dates are rolled so results match pandas BDay
+        key: tuple[datetime.date, int] = (date, n)
+        if key not in self.bday_cache:
+            roll: str = 'backward' if n > 0 else 'forward'
+            self.bday_cache[key] = np.busday_offset(np.datetime64(date, 'D'), n, roll=roll).astype(object)
+        return self.bday_cache[key]
+
+    def EarningsTickers(self, earnings_date):
+        # unique tickers with earnings on the given date in earnings data order, sliced out of the date sorted earnings rows
+        day: np.datetime64 = np.datetime64(earnings_date, 'D')
+        i: int = np.searchsorted(self.earnings_days, day)
+        if i == len(self.earnings_days) or self.earnings_days[i] != day:
+            return self.earnings_tickers[:0]
+        return self.earnings_tickers[self.earnings_start_idx[i]:self.earnings_start_idx[i + 1]]
+
     def DaysBefore(self):
         # every day check if 5 days from now is any earnings day
-        earnings_date: datetime.date = (self.Time + BDay(5)).date()
-        date_to_liquidate: datetime.date = (earnings_date + BDay(6)).date()
+        earnings_date: datetime.date = self.AddBusinessDays(self.Time.date(), 5)
+        date_to_liquidate: datetime.date = self.AddBusinessDays(earnings_date, 6)
 
-        if earnings_date not in self.earnings:
+        earnings_tickers: np.ndarray = self.EarningsTickers(earnings_date)
+        if len(earnings_tickers) == 0:
             return
 
-        for symbol in self.selected_symbols:
-
-            if symbol is None:
-                self.Debug("Symbol is None.")
-                continue
+        # is there any selected symbol which has earnings in 5 days
+        rows: np.ndarray = np.fromiter((self.ticker_rows[ticker] for ticker in earnings_tickers
+                                        if ticker in self.ticker_rows), dtype=np.int64)
+        for row in rows[self.selected_mask[rows]]:
+            symbol: Symbol = self.row_symbols[row]
+            ticker: str = self.symbol_tickers[symbol]
 
             if symbol not in self.Securities:
                 self.Debug(f'Symbol {symbol} not found in Securities')
                 continue
 
-            ticker: str = symbol.Value
-
-            if ticker is None:
-                self.Debug("Ticker is None.")
-                continue
-
-            # is there any symbol which has earnings in 5 days
-            if ticker not in self.earnings[earnings_date]:
+            # a managed symbol already has its option orders scheduled, the underlying itself is never invested
+            if symbol in self.managed_symbols:
                 continue
 
             if (len(self.managed_symbols) < self.managed_symbols_size) and not self.Securities[symbol].Invested and \
@@ -200,7 +305,7 @@ class PostEarningsAnnouncement(QCAlgorithm):
                     self.Debug(f'Option contract {option_contract} not found in Securities')
                     continue
 
-                buy_date: datetime.date = earnings_date - BDay(5)
+                buy_date: datetime.date = self.AddBusinessDays(earnings_date, -5)
                 contract = option_contract
 
                 if self.Securities.ContainsKey(option_contract):
@@ -233,35 +338,36 @@ class PostEarningsAnnouncement(QCAlgorithm):
 
                 # self.SetHoldings(option_contract, 1 / self.managed_symbols_size)
 
-                self.managed_symbols.append(
-                    data_tools.ManagedSymbol(symbol, earnings_date + BDay(1), date_to_liquidate))
+                self.managed_symbols[symbol] = data_tools.ManagedSymbol(
+                    symbol, self.AddBusinessDays(earnings_date, 1), date_to_liquidate)
+                heapq.heappush(self.liquidation_queue, (date_to_liquidate, next(self.liquidation_sequence), symbol))
 
             else:
-                self.Log(f"No option contract found for symbol: {symbol.Value} on earnings date: {earnings_date}")
+                self.Log(f"No option contract found for symbol: {ticker} on earnings date: {earnings_date}")
 
     def OnData(self, data):
         # switch positions on earnings days.
         curr_date: datetime.date = self.Time.date()
 
-        managed_symbols_to_delete: list[data_tools.ManagedSymbol] = []
-        for managed_symbol in self.managed_symbols:
-            if managed_symbol.symbol is None:
-                self.Debug(f"Managed symbol {managed_symbol} is none")
+        # switching is disabled, so only liquidation dates are queued; a switch step would pop date_to_switch here:
+        # if managed_symbol.date_to_switch == curr_date:
+        #     self.Log(" ")
+        #     # switch position from long to short
+        #     ##self.SetHoldings(managed_symbol.symbol, -1 / self.managed_symbols_size)
+        #     ## sell long calls, and then next line go long puts
+        queue: list[tuple[datetime.date, int, Symbol]] = self.liquidation_queue
+        while queue and queue[0][0] <= curr_date:
+            date_to_liquidate, _, symbol = heapq.heappop(queue)
+            managed_symbol = self.managed_symbols.get(symbol)
+
+            # stale entry of a symbol which was managed again with another liquidation date
+            if managed_symbol is None or managed_symbol.date_to_liquidate != date_to_liquidate:
                 continue
-            # elif managed_symbol.date_to_switch == curr_date:
-            #     self.Log(" ")
-            #     # switch position from long to short
-            #     ##self.SetHoldings(managed_symbol.symbol, -1 / self.managed_symbols_size)
-            #     ## sell long calls, and then next line go long puts
-
-            elif managed_symbol.date_to_liquidate <= curr_date:
-                ##self.Liquidate(managed_symbol.symbol)
-                managed_symbols_to_delete.append(managed_symbol)
-                # sell long puts
-
-        # remove symbols from management
-        for managed_symbol in managed_symbols_to_delete:
-            self.managed_symbols.remove(managed_symbol)
+
+            ##self.Liquidate(managed_symbol.symbol)
+            # remove symbol from management
+            del self.managed_symbols[symbol]
+            # sell long puts
 
     def Selection(self):
         # quarter selection